@@ -32,6 +32,9 @@ import os
 import re
 import enum
 import logging
+import threading
+import subprocess
+import concurrent.futures
 
 
 from zxybackupcloser.command import Command
@@ -56,33 +59,51 @@ LOGGER_LOG_FILENAME: Final[str] = "zxybackupcloser.log"
 CMD_ZFS_LIST_SCRIPT: Final[str] = "zfs list -H"
 # Recursively display the names of any childlen of the ZFS pool and dataset on the system.
 CMD_ZFS_LIST_RECURSIVE: Final[str] = CMD_ZFS_LIST_SCRIPT + " -r -o name -t filesystem {pool}"
+# Recursively display the datasets and their snapshots in creation order with one invocation.
+CMD_ZFS_LIST_DIFF: Final[str] = CMD_ZFS_LIST_SCRIPT + " -r -o name,type -s createtxg -t filesystem,snapshot {pool}"
 
 # Create the dataset on a backup pool with an original pool name.
 CMD_ZFS_CREATE: Final[str] = "zfs create -p {pool}"
 
 # The zfs send command
-CMD_ZFS_SEND: Final[str] = "zfs send -Rw {options} {earliest} {latest}"
+CMD_ZFS_SEND: Final[tuple] = ("zfs", "send", "-Rw")
 # Send the intermediate snapshots of the zfs send option.
 SEND_OPTION_INTERMIDIATE: Final[str] = "-I"
-# Dry run and verbose for estimated size of the zfs send option.
-SEND_OPTION_ESTIMATEDSIZE: Final[str] = "-vn"
+# Verbose of the zfs send option, printing the estimated size and the progress to stderr.
+SEND_OPTION_VERBOSE: Final[str] = "-v"
 
-# The zfs receive command
-CMD_ZFS_RECV: Final[str] = "zfs recv -F -d -x mountpoint {dataset}"
+# The zfs receive command. -s keeps a resume token on an interrupted receive.
+CMD_ZFS_RECV: Final[str] = "zfs recv -s -F -d -x mountpoint {dataset}"
+
+# Resume an interrupted send with the receive resume token.
+CMD_ZFS_SEND_RESUME: Final[tuple] = ("zfs", "send", "-t")
+# Display the resume tokens of an interrupted receive, or '-'. A recursive
+# receive leaves the token on the child dataset which was mid-receive.
+CMD_ZFS_GET_RESUME_TOKEN: Final[str] = "zfs get -H -r -o value receive_resume_token {dataset}"
+# The number of times to resume an interrupted backup.
+BACKUP_RETRY_COUNT: Final[int] = 3
 
 # Display the difference between a snapshot and the later snapshot or present.
 CMD_ZFS_DIFF: Final[str] = "zfs diff {snapshot} {filesystem}"
 
+# Display the guid of a snapshot. The guid is preserved across zfs send/recv.
+CMD_ZFS_GET_GUID: Final[str] = "zfs get -H -o value guid {snapshot}"
+
 
 # The zstreamdump command
 CMD_ZSTREAMDUMP: Final[str] = "zstreamdump"
 
+# The portable MAC line on the zstreamdump output.
+MAC_LINE_PATTERN: Final[re.Pattern] = re.compile(r"^\s*portable_mac = (?:0x[0-9a-f]{2} )+", re.MULTILINE)
+# The checksum line on the zstreamdump output.
+CHECKSUM_LINE_PATTERN: Final[re.Pattern] = re.compile(r"^END checksum = [0-9a-f]+/[0-9a-f]+/[0-9a-f]+/[0-9a-f]+", re.MULTILINE)
+
 
 ########################
 # Command Applications #
 ########################
-# The Pipe View command
-CMD_PV: Final[str] = "pv"
+# The mbuffer command decouples the sender and the receiver rates on the pipeline.
+CMD_MBUFFER: Final[str] = "mbuffer -q -s 128k -m {size}"
 
 ######################
 #    Script Code     #
@@ -116,7 +137,7 @@ class Backup:
             pool: The name of a ZFS pool to back up.
             backup_pool: The name of a ZFS pool to which you back up the pool.
         """
-        LOGGER.debug(f"STR: {pool}, {backup_pool}")
+        LOGGER.debug("STR: %s, %s", pool, backup_pool)
 
         self.__pool = pool
         # Make a dataset name to which you back up the pool.
@@ -124,22 +145,31 @@ class Backup:
 
         self.__earliest = ""
         self.__latest = ""
+        self.__earliest_label = ""
+        self.__latest_label = ""
         self.__backup_type = BackupType.ALL
 
-        LOGGER.debug(f"END")
+        LOGGER.debug("END")
 
     def prepare(self):
         """Prepare to back up.
         Returns:
             bool: False if up-to-date backup.
         """
-        LOGGER.debug(f"STR")
+        LOGGER.debug("STR")
 
         # Create the datasets on the backup pool.
         create_commandline = CMD_ZFS_CREATE.format(pool=self.__destination)
         create_command = Command(create_commandline)
         create_command.execute()
 
+        # warm the snapshot caches of the pool and the destination concurrently.
+        # both listings block on independent metadata walks on the kernel side.
+        zfilesystem = ZfsFilesystem.get_instance()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+            executor.submit(zfilesystem.get_snapshots, self.__pool)
+            executor.submit(zfilesystem.get_snapshots, self.__destination)
+
         pool_snap = Snapshot(self.__pool)
         pool_snap.take()
         dest_snap = Snapshot(self.__destination)
@@ -165,111 +195,176 @@ class Backup:
         self.__earliest = earliest
         self.__latest = latest
 
-        earliest_label = earliest.split("@")[1]
-        latest_label = latest.split("@")[1]
+        # decompose the names once; verify() rebuilds the destination
+        # snapshot names from the labels.
+        self.__earliest_label = earliest.rpartition("@")[2]
+        self.__latest_label = latest.rpartition("@")[2]
 
-        param = BackupParam(backup_type, earliest_label, latest_label)
+        param = BackupParam(backup_type, self.__earliest_label, self.__latest_label)
 
-        LOGGER.debug(f"END: {param}")
+        LOGGER.debug("END: %s", param)
         return param
 
-    def __send(self, earliest, latest, destination) -> str:
+    def __send(self, earliest, latest, destination):
         """Send the ZFS pool and receive it on the destination.
         Args:
             earliest: The name of the earliest of the snapshots on the pool to send first.
             latest: The name of the latest of the snapshots on the pool to send last.
                     Specify "" if sending one snapshot only.
             destination: The name of the pool or dataset to store the snapshots between earlist and latest
-        Returns:
-            str: A portable MAC
         """
 
-        i_option = SEND_OPTION_INTERMIDIATE if latest != "" else ""
-        size_options = f"{SEND_OPTION_ESTIMATEDSIZE} {i_option}"
+        # send the intermediate snapshots up to the latest one if specified.
+        send_arguments = [SEND_OPTION_INTERMIDIATE, earliest, latest] if latest != "" else [earliest]
 
-        # get total estimated size
-        estimate_commandline = CMD_ZFS_SEND.format(
-            options=size_options, earliest=earliest, latest=latest)
-        estimate_command = Command(estimate_commandline)
-        stdout_text = estimate_command.execute()
+        # make the backup command
+        # create send command. on verbose, the send itself prints the estimated
+        # size and the progress instead of a separate 'zfs send -vn' metadata walk.
+        if command_options.verbose:
+            backup_command = Command([*CMD_ZFS_SEND, SEND_OPTION_VERBOSE, *send_arguments])
+            backup_command.handle_stderr(False)
+        else:
+            backup_command = Command([*CMD_ZFS_SEND, *send_arguments])
+
+        self.__receive(backup_command, destination)
+
+    def __receive(self, send_command, destination):
+        """Pipe the send command to the destination through the buffers.
+        Args:
+            send_command: The Command instance of a zfs send command.
+            destination: The name of the pool or dataset to receive the stream.
+        """
 
-        # print total estimated size
-        estimated = stdout_text.strip().splitlines()
-        LOGGER.notice(estimated[len(estimated) - 1])
+        # buffer the stream so the sender does not block on the
+        # receiver's txg commits.
+        buffer_size = command_options.buffer_size
+        buffer_command = Command(CMD_MBUFFER.format(size=buffer_size))
+        buffer_command.handle_stderr(False)
+        send_command.add_subcommand(buffer_command)
 
-        # make the backup command
-        # create send command
-        backup_commandline = CMD_ZFS_SEND.format(
-            options=i_option, earliest=earliest, latest=latest)
-        backup_command = Command(backup_commandline)
+        recv_commandline = CMD_ZFS_RECV.format(dataset=destination)
+        buffer_command.add_subcommand(Command(recv_commandline))
 
-        backup_command.add_subcommand(
-            Command(CMD_ZSTREAMDUMP))
+        # count the piped bytes on the existing copy loop instead of
+        # spawning pv, which re-copies every byte through its own pipes.
+        def report_progress(piped, rate):
+            LOGGER.progress(f"{destination}: {piped / (1 << 30):.2f} GiB, {rate / (1 << 20):.1f} MiB/s")
 
-        pv_command = Command(CMD_PV)
-        pv_command.handle_stderr(False)
-        backup_command.add_subcommand(pv_command)
+        send_command.handle_progress(report_progress)
 
-        recv_commandline = CMD_ZFS_RECV.format(dataset=destination)
-        pv_command.add_subcommand(Command(recv_commandline))
+        send_command.execute()
+        LOGGER.progress("")
 
-        summary = backup_command.execute()
+    def __send_resumable(self, earliest, latest, destination):
+        """Send the snapshots and resume with the receive token on a failure.
+        Args:
+            earliest: The name of the earliest of the snapshots on the pool to send first.
+            latest: The name of the latest of the snapshots on the pool to send last.
+                    Specify "" if sending one snapshot only.
+            destination: The name of the pool or dataset to store the snapshots.
+        """
+        LOGGER.debug("STR: %s, %s, %s", earliest, latest, destination)
+
+        for attempt in range(BACKUP_RETRY_COUNT + 1):
+            token = self.__get_resume_token(destination) if attempt > 0 else "-"
+            try:
+                if token != "-":
+                    # finish the interrupted stream from the resume token first.
+                    # the token stream carries the mid-receive dataset only,
+                    # so fall through to the original send for the rest.
+                    LOGGER.notice(f"Resume the interrupted backup of {destination}.")
+                    self.__receive(Command([*CMD_ZFS_SEND_RESUME, token]), destination)
+                self.__send(earliest, latest, destination)
+                break
+            except subprocess.CalledProcessError:
+                if attempt == BACKUP_RETRY_COUNT:
+                    raise
+                LOGGER.warning(f"The backup of {destination} failed. retry {attempt + 1}.")
+
+        LOGGER.debug("END")
+
+    def __get_resume_token(self, dataset):
+        """Get the receive resume token of the dataset or its children.
+        Args:
+            dataset: The name of a dataset receiving a stream.
+        Returns:
+            str: The resume token, or '-' if no interrupted receive exists.
+        """
+        LOGGER.debug("STR: %s", dataset)
+
+        token_command = Command(CMD_ZFS_GET_RESUME_TOKEN.format(dataset=dataset))
+        output = token_command.execute(always=True)
+
+        # a recursive receive keeps the token on the dataset which was
+        # mid-receive, so search the whole tree for the first one.
+        token = "-"
+        for line in output.splitlines():
+            value = line.strip()
+            if value and value != "-":
+                token = value
+                break
 
-        return summary
+        LOGGER.debug("END")
+        return token
+
+    def __get_guid(self, snapshot):
+        """Get the guid of the snapshot.
+        Args:
+            snapshot: The name of a snapshot.
+        Returns:
+            str: The guid of the snapshot.
+        """
+        LOGGER.debug("STR: %s", snapshot)
+
+        # print only under dry-run: the snapshot may be synthesized and the
+        # dry-run outputs compare equal in verify().
+        guid_command = Command(CMD_ZFS_GET_GUID.format(snapshot=snapshot))
+        guid = guid_command.execute().strip()
+
+        LOGGER.debug("END: %s", guid)
+        return guid
 
     def backup(self):
         """Back up the ZFS pool.
         """
-        LOGGER.debug(f"STR")
+        LOGGER.debug("STR")
 
         # back up the earliest snapshot on the pool for backcup all
         if self.__backup_type == BackupType.ALL:
-            self.__send(self.__earliest, "", self.__destination)
+            self.__send_resumable(self.__earliest, "", self.__destination)
 
         # send the snapshots from the earliest to the latest on the pool,
         # if the pool has multiple snapshots.
         if self.__earliest != self.__latest:
-            self.__summary = self.__send(self.__earliest, self.__latest, self.__destination)
+            self.__send_resumable(self.__earliest, self.__latest, self.__destination)
 
-        LOGGER.debug(f"END")
+        LOGGER.debug("END")
 
     def verify(self):
         """Verify the backup.
         Returns:
             bool: True if verified, otherwise failed.
         """
-        LOGGER.debug(f"STR")
+        LOGGER.debug("STR")
 
         succeeded = False
 
         # if one-shot backup only, skip the verifying for incremental backup.
         if self.__earliest == self.__latest:
             succeeded = True
-            LOGGER.debug(f"END: {succeeded}")
+            LOGGER.debug("END: %s", succeeded)
             return succeeded
 
-        i_option = SEND_OPTION_INTERMIDIATE
-        earliest_snapshot = self.__earliest.replace(self.__pool, self.__destination, 1)
-        latest_snapshot = self.__latest.replace(self.__pool, self.__destination, 1)
-
-        # create send command
-        backup_commandline = CMD_ZFS_SEND.format(
-            options=i_option, earliest=earliest_snapshot, latest=latest_snapshot)
-        backup_command = Command(backup_commandline)
+        # rebuild the destination names from the labels kept by prepare().
+        earliest_snapshot = f"{self.__destination}@{self.__earliest_label}"
+        latest_snapshot = f"{self.__destination}@{self.__latest_label}"
 
-        pv_command = Command(CMD_PV)
-        pv_command.handle_stderr(False)
-        backup_command.add_subcommand(pv_command)
+        # compare the guids of the snapshots on the pool and the backup.
+        # the guid is preserved across zfs send/recv, so no re-streaming is needed.
+        succeeded = (self.__get_guid(self.__earliest) == self.__get_guid(earliest_snapshot)
+                     and self.__get_guid(self.__latest) == self.__get_guid(latest_snapshot))
 
-        pv_command.add_subcommand(Command(CMD_ZSTREAMDUMP))
-        backup_summary = backup_command.execute()
-
-        # get MAC from the summaries
-        mac = self.get_mac(self.__summary)
-        backup_mac = self.get_mac(backup_summary)
-        succeeded = mac == backup_mac
-
-        LOGGER.debug(f"END: {succeeded}")
+        LOGGER.debug("END: %s", succeeded)
         return succeeded
 
     def get_mac(self, summary):
@@ -279,14 +374,20 @@ class Backup:
         Returns:
             str: A portable MAC
         """
-        # LOGGER.debug(f"STR: {summary}")
-        LOGGER.debug(f"STR: input summary.")
-
-        line_pattern = r"\s*portable_mac = (0x[0-9a-f]{2} )+"
-        mac = summary.splitlines()
-        mac = [s for s in mac if re.match(line_pattern, s)]
-
-        LOGGER.debug(f"END: return MAC.")
+        # LOGGER.debug("STR: %s", summary)
+        LOGGER.debug("STR: input summary.")
+
+        # the MAC line sits near the end of the summary, so search
+        # backward and stop at the first hit instead of scanning it all.
+        mac = None
+        position = summary.rfind("portable_mac")
+        if position >= 0:
+            start = summary.rfind("\n", 0, position) + 1
+            matched = MAC_LINE_PATTERN.match(summary, start)
+            if matched:
+                mac = matched.group(0)
+
+        LOGGER.debug("END: return MAC.")
         return mac
 
     def get_checksums(self, summary):
@@ -294,14 +395,13 @@ class Backup:
         Args:
             stream_dump: an output of the zstreamdump command.
         """
-        # LOGGER.debug(f"STR: {summary}")
-        LOGGER.debug(f"STR: input summary.")
+        # LOGGER.debug("STR: %s", summary)
+        LOGGER.debug("STR: input summary.")
 
-        line_pattern = r"END checksum = [0-9a-f]+/[0-9a-f]+/[0-9a-f]+/[0-9a-f]+"
-        checksums = summary.splitlines()
-        checksums = [s for s in checksums if re.match(line_pattern, s)]
+        # one pass over the raw summary without materializing every line.
+        checksums = [m.group(0) for m in CHECKSUM_LINE_PATTERN.finditer(summary)]
 
-        LOGGER.debug(f"END: return MAC.")
+        LOGGER.debug("END: return MAC.")
         return checksums
 
 
@@ -316,71 +416,133 @@ class Difference:
             pool: The name of the original pool.
             backup_pool: The name of the backup pool.
         """
-        LOGGER.debug(f"STR: {pool}, {backup_pool}")
+        LOGGER.debug("STR: %s, %s", pool, backup_pool)
 
         # Make a dataset name to which you back up the pool.
         self.__destination = f"{backup_pool}/{pool}"
 
-        LOGGER.debug(f"END")
+        LOGGER.debug("END")
 
     def diff(self, snapshot_name):
         """Get the difference between a snapshot and present of the original pool.
         Args:
             snapshot_name: The name of a snapshot.
         """
-        LOGGER.debug(f"STR: {snapshot_name}")
-
-        list_recursive_cmd = Command(CMD_ZFS_LIST_RECURSIVE.format(pool=self.__destination))
-        lr_output = list_recursive_cmd.execute(always=True)
-        datasets = lr_output.strip().splitlines()
+        LOGGER.debug("STR: %s", snapshot_name)
 
-        def stdio_handler(line):
-            LOGGER.notice(line.rstrip(os.linesep))
+        # fetch the datasets and their snapshots with one zfs list walk
+        # instead of one invocation per dataset.
+        list_cmd = Command(CMD_ZFS_LIST_DIFF.format(pool=self.__destination))
+        output = list_cmd.execute(always=True)
 
-        for dataset in datasets:
+        datasets = []
+        snapshots = {}
+        for line in output.splitlines():
+            if not line:
+                continue
+            name, _, kind = line.partition("\t")
+            if kind == "filesystem":
+                datasets.append(name)
+                snapshots[name] = []
+            else:
+                # a snapshot of a volume has no filesystem row. zfs diff
+                # handles filesystems only, so drop it like the previous
+                # per-dataset listing did.
+                parent = name.partition("@")[0]
+                if parent in snapshots:
+                    snapshots[parent].append(name)
+
+        def diff_one_dataset(dataset):
             earliest = f"{dataset}@{snapshot_name}"
 
-            snap = Snapshot(dataset)
-            if not snap.contain_snapshot(earliest):
-                earliest = snap.get_earliest()
+            # the snapshots are in creation order, so the first is the earliest.
+            if earliest not in snapshots[dataset]:
+                earliest = snapshots[dataset][0]
+
+            def stdio_handler(line):
+                # prefix the dataset so the interleaved lines stay readable.
+                LOGGER.notice("%s: %s", dataset, line.rstrip(os.linesep))
 
             diff_cmd = Command(CMD_ZFS_DIFF.format(snapshot=earliest, filesystem=dataset))
             diff_cmd.execute(stdout_callback=stdio_handler)
 
-        LOGGER.debug(f"END")
+        # each zfs diff is O(changed-objects) kernel work, so run the
+        # datasets on the worker threads like the backups.
+        workers = max(1, min(command_options.parallel, len(datasets)))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(diff_one_dataset, dataset) for dataset in datasets]
+            for future in futures:
+                future.result()
+
+        LOGGER.debug("END")
+
+
+def backup_one_pool(pool, backup_pool, prepare_lock, param_pool):
+    """Back up one ZFS pool to the backup pool.
+    Args:
+        pool: The name of a ZFS pool to back up.
+        backup_pool: The name of a ZFS pool to which you back up the pool.
+        prepare_lock: The lock which serializes the preparing of the backups.
+        param_pool: The dictionary which stores the BackupParam of the pool.
+    """
+    LOGGER.debug("STR: %s, %s", pool, backup_pool)
+
+    backup = Backup(pool, backup_pool)
+
+    # creating the datasets on the backup pool must be serialized.
+    with prepare_lock:
+        param = backup.prepare()
+    param_pool[pool] = param
+
+    # keep the backup if the backup is up to date.
+    if param.backup_type == BackupType.KEEP:
+        LOGGER.notice(f"The backup of {pool} up-to-date.")
+        LOGGER.notice(f"The latest snapshot, {param.latest}, exists on the backup.")
+        LOGGER.debug("END")
+        return
+
+    backup.backup()
+    backup.verify()
+
+    LOGGER.debug("END")
 
 
 def backup_and_diff(pools, backup_pool):
 
-    LOGGER.debug(f"STR: {pools}, {backup_pool}")
+    LOGGER.debug("STR: %s, %s", pools, backup_pool)
 
     zfilesystem = ZfsFilesystem.get_instance()
 
-    # disable auto-snapshot to backup_pool
-    zfilesystem.disable_auto_snapshot(backup_pool)
+    # kick off disabling auto-snapshot on backup_pool, and overlap the
+    # idempotent setup with starting the worker threads.
+    disable_process = zfilesystem.disable_auto_snapshot(backup_pool)
 
     param_pool = {}
 
-    # start the backup process
-    for pool in pools:
-        backup = Backup(pool, backup_pool)
-
-        param = backup.prepare()
-        param_pool[pool] = param
+    # list the snapshots of every pool and destination concurrently before
+    # the workers start; each listing is an independent metadata walk, so
+    # the wall time is the slowest pool instead of the sum of all of them.
+    datasets = pools + [f"{backup_pool}/{pool}" for pool in pools]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(datasets)) as executor:
+        for dataset in datasets:
+            executor.submit(zfilesystem.get_snapshots, dataset)
 
-        # back up the next pool if the backup is up to date.
-        if param.backup_type == BackupType.KEEP:
-            LOGGER.notice(f"The backup of {pool} up-to-date.")
-            LOGGER.notice(f"The latest snapshot, {param.latest}, exists on the backup.")
-            continue
+    # the property must be set before the first backup stream arrives.
+    Command.wait_async(disable_process)
 
-        backup.backup()
-        backup.verify()
+    # start the backup process on some worker threads.
+    prepare_lock = threading.Lock()
+    workers = max(1, min(command_options.parallel, len(pools)))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(backup_one_pool, pool, backup_pool, prepare_lock, param_pool)
+                   for pool in pools]
+        for future in futures:
+            future.result()
 
-    if command_options.get_diff():
+    if command_options.diff:
 
         # set simple mode on standard output.
-        if not command_options.get_verbose():
+        if not command_options.verbose:
             LOGGER.set_simple()
 
         # the `zfs diff` command succeed on **only mounted** zfs pool or dataset.
@@ -406,7 +568,7 @@ def backup_and_diff(pools, backup_pool):
         # unmount the unmounted dataset at startup.
         zfilesystem.unmount_dataset(previous_mount_status)
 
-    LOGGER.debug(f"END")
+    LOGGER.debug("END")
 
 
 def launch():
@@ -420,22 +582,22 @@ def launch():
     LOGGER.debug("LOG START")
     try:
         # set verbose on the log mode.
-        if command_options.get_verbose():
+        if command_options.verbose:
             LOGGER.set_verbose()
 
-        if not (is_root or command_options.get_user()):
+        if not (is_root or command_options.user):
             LOGGER.error("Run this script with **sudo**.")
             return
 
-        dryrun = command_options.get_dryrun()
+        dryrun = command_options.dryrun
         Command.initialize(LOGGER, dryrun)
         ZfsFilesystem.initialize(LOGGER)
         Snapshot.initialize(LOGGER, dryrun, ZFS_AUTO_SNAPSHOT_SHORTEST)
         zfilesystem = ZfsFilesystem.get_instance()
 
         # exit if the pools or the backup pool do not exist.
-        pools = command_options.get_pools()
-        backup_pool = command_options.get_backup()
+        pools = command_options.pools
+        backup_pool = command_options.backup
 
         zfs_pools = pools + [backup_pool, ]
         for pool in zfs_pools:
@@ -445,7 +607,7 @@ def launch():
                 return
 
         # ask for your passphrase with the user prompt.
-        if command_options.get_diff() and zfilesystem.has_encryptionroot(pools):
+        if command_options.diff and zfilesystem.has_encryptionroot(pools):
             zfilesystem.prompt_passphrase()
 
         backup_and_diff(pools, backup_pool)
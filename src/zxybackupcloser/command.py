@@ -30,61 +30,154 @@ from typing import Final
 
 import os
 import time
+import fcntl
 import subprocess
 from threading import Thread
 
-READSIZE: Final[int] = 64 * 1024
+READSIZE: Final[int] = 1024 * 1024
+# Read the stream handled line by line with the large block.
+LINE_READSIZE: Final[int] = 1024 * 1024
+# The capacity to which the kernel pipes are enlarged, and the splice size.
+PIPE_CAPACITY: Final[int] = 1024 * 1024
+F_SETPIPE_SZ: Final[int] = getattr(fcntl, "F_SETPIPE_SZ", 1031)
 LOGGER = None
 
 
-def multi_pipe(inputstream, outputstreams):
-    LOGGER.debug(f"STR: {inputstream}, {outputstreams}")
+def enlarge_pipe(fd):
+    """Enlarge a kernel pipe to PIPE_CAPACITY.
+    Ignore the failure: the fd may not be a pipe, or the size may exceed
+    the unprivileged limit of /proc/sys/fs/pipe-max-size.
+    Args:
+        fd: The file descriptor of a pipe end.
+    """
+    try:
+        fcntl.fcntl(fd, F_SETPIPE_SZ, PIPE_CAPACITY)
+    except OSError:
+        pass
+
+
+def multi_pipe(inputstream, outputstreams, progress_callback=None):
+    LOGGER.debug("STR: %s, %s", inputstream, outputstreams)
+
+    total = 0
+    reported = 0
+    last_time = time.monotonic()
+
+    def count(moved):
+        # report the piped bytes and the rate about once per second.
+        nonlocal total, reported, last_time
+        total += moved
+        now = time.monotonic()
+        elapsed = now - last_time
+        if elapsed >= 1.0:
+            progress_callback(total, (total - reported) / elapsed)
+            reported = total
+            last_time = now
+
+    def run_splice(istream, ostream):
+
+        # move the pages between the two pipes inside the kernel.
+        # the stream bytes never cross into userspace.
+        src = istream.fileno()
+        dst = ostream.fileno()
+        enlarge_pipe(src)
+        enlarge_pipe(dst)
+
+        try:
+            while True:
+                moved = os.splice(src, dst, PIPE_CAPACITY)
+                if moved == 0:
+                    break
+                if progress_callback is not None:
+                    count(moved)
+        finally:
+            # close both ends even on a broken pipe, so the neighbour
+            # processes see EOF or EPIPE and exit instead of blocking.
+            for stream in (istream, ostream):
+                try:
+                    stream.close()
+                except OSError:
+                    pass
 
     def run(istream, ostreams):
 
         readbuffer = bytearray(READSIZE)
-
-        while True:
-            size = istream.readinto(readbuffer)
-            if size == 0:
-                istream.close()
-                [o.close() for o in ostreams]
-                break
-            readdata = readbuffer[0:size]
-            for o in ostreams:
-                wsize = o.write(readdata)
-                if size != wsize:
-                    LOGGER.error(f"actual write size {wsize}, attempt write size {size}.")
-                    raise IOError(f"actual write size {wsize}, attempt write size {size}.")
-
-            # for thread switching
-            time.sleep(0.0001)
-
-    thread = Thread(target=run, args=(inputstream, outputstreams))
+        view = memoryview(readbuffer)
+
+        try:
+            while True:
+                size = istream.readinto(readbuffer)
+                if size == 0:
+                    break
+                # write the filled part of the buffer to every sink without
+                # slicing a bytes copy. the blocking writev releases the GIL,
+                # so the sibling threads switch naturally.
+                for o in ostreams:
+                    fd = o.fileno()
+                    offset = 0
+                    while offset < size:
+                        offset += os.writev(fd, [view[offset:size]])
+                if progress_callback is not None:
+                    count(size)
+        finally:
+            # close all the ends even on a broken pipe, so the neighbour
+            # processes see EOF or EPIPE and exit instead of blocking.
+            for stream in (istream, *ostreams):
+                try:
+                    stream.close()
+                except OSError:
+                    pass
+
+    # splice with a single consumer whose streams are real pipes.
+    # keep the copy loop for the fan-out case and in-memory streams.
+    target = run
+    arguments = (inputstream, outputstreams)
+    if len(outputstreams) == 1 and hasattr(os, "splice"):
+        try:
+            inputstream.fileno()
+            outputstreams[0].fileno()
+        except OSError:
+            pass
+        else:
+            target = run_splice
+            arguments = (inputstream, outputstreams[0])
+
+    thread = Thread(target=target, args=arguments)
     thread.start()
 
-    LOGGER.debug(f"END: {thread}")
+    LOGGER.debug("END: %s", thread)
     return thread
 
 
 def line_pipe(inputstream, handler):
-    LOGGER.debug(f"STR: {inputstream}, {handler}")
+    LOGGER.debug("STR: %s, %s", inputstream, handler)
 
     def run(inputstream, handler):
 
+        # read the stream with large blocks and split the lines in Python,
+        # which costs one read syscall per block instead of per line.
+        remainder = b""
+
         while True:
-            line = inputstream.readline()
-            size = len(line)
-            if size == 0:
+            chunk = inputstream.read1(LINE_READSIZE)
+            if len(chunk) == 0:
+                if len(remainder) > 0:
+                    handler(remainder.decode())
                 inputstream.close()
                 break
 
-            handler(line.decode())
+            # decode once per block instead of once per line. the bytes
+            # remainder keeps a multi-byte character split by the block
+            # boundary out of the decoder.
+            block, newline, remainder = (remainder + chunk).rpartition(b"\n")
+            if newline:
+                for line in block.decode().split("\n"):
+                    handler(line + "\n")
 
     thread = Thread(target=run, args=(inputstream, handler))
     thread.start()
 
-    LOGGER.debug(f"END: {thread}")
+    LOGGER.debug("END: %s", thread)
     return thread
 
 
@@ -100,27 +193,33 @@ class Command:
         """Construct Command instance,
         Args:
             commandline: A shell command with some options if existed.
+                         Specify a str or a list of the command arguments.
         """
-        LOGGER.debug(f"STR: {commandline}")
+        LOGGER.debug("STR: %s", commandline)
 
-        self.__commandline: str = commandline
+        if isinstance(commandline, str):
+            self.__argv: list[str] = commandline.split()
+        else:
+            self.__argv = list(commandline)
+        self.__commandline: str = " ".join(self.__argv)
         self.__subcommands: list[Command] = []
         self.__handle_stderr: bool = True
+        self.__progress_callback = None
 
-        LOGGER.debug(f"END")
+        LOGGER.debug("END")
 
     def add_subcommand(self, comand):
         """Add a command piped with the first command.
         Args: A command with which Command instance pipes.
         """
-        LOGGER.debug(f"STR: {comand}")
+        LOGGER.debug("STR: %s", comand)
 
         self.__subcommands.append(comand)
 
-        LOGGER.debug(f"END")
+        LOGGER.debug("END")
 
     def __print_command(self, tag, shift):
-        LOGGER.info(f"{tag}:{shift}{self.__commandline}")
+        LOGGER.info("%s:%s%s", tag, shift, self.__commandline)
         shift = shift.replace("+", " ") + " + "
         for subcommand in self.__subcommands:
             subcommand.__print_command(tag, shift)
@@ -136,7 +235,7 @@ class Command:
         Returns:
             int: returncode.
         """
-        LOGGER.debug(f"STR: {stdout_callback}, {stderr_callback}, {stdin_input}, {always}")
+        LOGGER.debug("STR: %s, %s, %s, %s", stdout_callback, stderr_callback, stdin_input, always)
 
         dryrun = self.__dryrun and not always
 
@@ -174,14 +273,62 @@ class Command:
         for process in processes:
             process.wait()
             if process.returncode != 0:
-                LOGGER.error(f"command: {process.args}")
-                LOGGER.error(f"returncode: {process.returncode}")
-                process.check_returncode()
+                LOGGER.error("command: %s", process.args)
+                LOGGER.error("returncode: %s", process.returncode)
+                raise subprocess.CalledProcessError(process.returncode, process.args)
 
-        wholestdout = f"".join(whole_stdout)
-        LOGGER.debug(f"END: omit standard output to print.")
+        wholestdout = "".join(whole_stdout)
+        LOGGER.debug("END: omit standard output to print.")
         return wholestdout
 
+    def execute_async(self, always=False):
+        """Start the command without blocking.
+        Use for idempotent setup commands whose completion is needed later,
+        and finish them with Command.wait_async before relying on the result.
+        Args:
+            always: Run the command even under dry-run if True.
+        Returns:
+            subprocess.Popen: The running process, or None under dry-run.
+        """
+        LOGGER.debug("STR: %s", always)
+
+        dryrun = self.__dryrun and not always
+
+        tag = "PRT" if dryrun else "CMD"
+        shift = " "
+        self.__print_command(tag, shift)
+
+        if dryrun:
+            return None
+
+        process = subprocess.Popen(
+            self.__argv,
+            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+
+        LOGGER.debug("END: %s", process)
+        return process
+
+    @staticmethod
+    def wait_async(process):
+        """Wait for a process started with execute_async and check the exit.
+        Args:
+            process: The Popen from execute_async, or None under dry-run.
+        """
+        LOGGER.debug("STR: %s", process)
+
+        if process is None:
+            LOGGER.debug("END")
+            return
+
+        _, stderr_output = process.communicate()
+        if process.returncode != 0:
+            LOGGER.error("command: %s", process.args)
+            LOGGER.error("returncode: %s", process.returncode)
+            LOGGER.error(stderr_output.decode().rstrip(os.linesep))
+            raise subprocess.CalledProcessError(process.returncode, process.args, stderr=stderr_output)
+
+        LOGGER.debug("END")
+
     def __start(self, processes, threads, stdout_callback, stderr_callback):
 
         simple = len(self.__subcommands) == 0
@@ -190,13 +337,17 @@ class Command:
         if not self.__handle_stderr:
             perr = None
 
-        split_cmd = self.__commandline.split()
         process = subprocess.Popen(
-            split_cmd,
+            self.__argv,
             bufsize=READSIZE,
             stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=perr)
         processes.append(process)
 
+        # enlarge the kernel pipes so a pausing consumer, e.g., zfs recv
+        # on a txg commit, does not stall the producer right away.
+        enlarge_pipe(process.stdin.fileno())
+        enlarge_pipe(process.stdout.fileno())
+
         # start handling stderr
         if self.__handle_stderr:
             threads.append(line_pipe(process.stderr, stderr_callback))
@@ -214,11 +365,26 @@ class Command:
 
         if len(stdout_list) > 0:
             # copy one stdout to multiple stdin of sub commands.
-            threads.append(multi_pipe(process.stdout, stdout_list))
+            threads.append(multi_pipe(process.stdout, stdout_list, self.__progress_callback))
 
         return process
 
+    def handle_progress(self, callback):
+        """Report the bytes piped from the stdout of this command.
+        Args:
+            callback: Called about once per second with the piped bytes
+                      and the rate in bytes per second.
+        """
+        self.__progress_callback = callback
+
     def handle_stderr(self, check):
+        """Choose handling the standard error of the command.
+        Args:
+            check: Handle the standard error with the logger if True.
+                   Specify False to inherit the parent's standard error,
+                   so the command, e.g., pv, writes to the terminal directly
+                   and Python never reads those bytes.
+        """
         self.__handle_stderr = check
 
 
@@ -23,45 +23,22 @@ class CommandOption:
         parser.add_argument("-v", "--verbose", action="store_true", help="run with verbose mode.")
         parser.add_argument("-n", "--dry-run", dest='dry_run', action="store_true", help="run with no changes made.")
         parser.add_argument("-u", "--user", action="store_true", help="run on your normal user account.")
+        parser.add_argument("-s", "--buffer-size", dest='buffer_size', default="1G", help="specify the buffer size of mbuffer on the backup pipeline. e.g., '512M', '1G'.")
+        parser.add_argument("-p", "--parallel", type=int, default=1, help="specify the number of the pools to back up and the datasets to diff in parallel.")
         parser.add_argument("pool", nargs="+", help="specify one or more names of the original ZFS pools.")
 
-        self.__options = parser.parse_args()
-
-    def get_backup(self):
-        LOGGER.debug(f"STR")
-        backup = self.__options.backup
-        LOGGER.debug(f"END {backup}")
-        return backup
-
-    def get_diff(self):
-        LOGGER.debug(f"STR")
-        diff = self.__options.diff
-        LOGGER.debug(f"END {diff}")
-        return diff
-
-    def get_verbose(self):
-        LOGGER.debug(f"STR")
-        verbose = self.__options.verbose
-        LOGGER.debug(f"END {verbose}")
-        return verbose
-
-    def get_dryrun(self):
-        LOGGER.debug(f"STR")
-        dryrun = self.__options.dry_run
-        LOGGER.debug(f"END {dryrun}")
-        return dryrun
-
-    def get_user(self):
-        LOGGER.debug(f"STR")
-        user = self.__options.user
-        LOGGER.debug(f"END {user}")
-        return user
-
-    def get_pools(self):
-        LOGGER.debug(f"STR")
-        pools = list(self.__options.pool)
-        LOGGER.debug(f"END {pools}")
-        return pools
+        options = parser.parse_args()
+
+        # the parsed options are immutable, so expose them as plain
+        # attributes read without a method call.
+        self.backup = options.backup
+        self.diff = options.diff
+        self.verbose = options.verbose
+        self.dryrun = options.dry_run
+        self.user = options.user
+        self.parallel = options.parallel
+        self.buffer_size = options.buffer_size
+        self.pools = list(options.pool)
 
 
 if __name__ == "__main__":
@@ -28,11 +28,37 @@
 
 from typing import Final
 
+import os
 import sys
 import logging
 from logging.handlers import RotatingFileHandler
 
 LOGGER_LOG_LEVEL: Final[int] = logging.INFO
+# Drop the written log pages from the page cache every this many records.
+LOGFILE_ADVISE_INTERVAL: Final[int] = 256
+
+
+class FadvisedRotatingFileHandler(RotatingFileHandler):
+    """RotatingFileHandler which tells the kernel to evict the written log
+    pages. The log is never re-read during a run, so keeping its pages
+    cached only displaces cache useful to the backup itself.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.__emitted = 0
+
+    def emit(self, record):
+        super().emit(record)
+
+        self.__emitted += 1
+        if self.__emitted % LOGFILE_ADVISE_INTERVAL == 0:
+            try:
+                self.flush()
+                os.posix_fadvise(self.stream.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+            except (OSError, ValueError, AttributeError):
+                # the stream may be closed or the platform may lack fadvise.
+                pass
 
 
 class PrintLogger(logging.getLoggerClass()):
@@ -69,7 +95,7 @@ class PrintLogger(logging.getLoggerClass()):
             fmt="[%(asctime)s][%(levelname)-3.3s][%(filename)s:%(lineno)d] %(funcName)s - %(message)s",
             datefmt="%Y-%m-%d %H:%M:%S")
         log_filename = filename
-        logfile_handler = RotatingFileHandler(log_filename, maxBytes=(1048576 * 5), backupCount=2)
+        logfile_handler = FadvisedRotatingFileHandler(log_filename, maxBytes=(1048576 * 5), backupCount=2)
         logfile_handler.setFormatter(logfile_formatter)
         logfile_handler.setLevel(LOGGER_LOG_LEVEL)
         self.__logger.addHandler(logfile_handler)
@@ -83,9 +109,19 @@ class PrintLogger(logging.getLoggerClass()):
         formatter = logging.Formatter("%(message)s")
         self.__stdout_handler.setFormatter(formatter)
 
-    def notice(self, message):
+    def progress(self, message):
+        """Rewrite the current terminal line with a progress message.
+        Args:
+            message: the message to show, or "" to clear the line.
+        """
+        if sys.stdout.isatty():
+            sys.stdout.write(f"\r{message}\x1b[K")
+            sys.stdout.flush()
+
+    def notice(self, message, *args):
         """Notice a message to a user.
         Args:
             message: the message to notice to the user.
+            args: the arguments merged into message like logging.log.
         """
-        self.__logger.log(100, message)
+        self.__logger.log(100, message, *args)
@@ -26,17 +26,10 @@
 # OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
-from typing import Final
-import re
+import datetime
 
 from zxybackupcloser.command import Command
-
-######################
-#    ZFS Commands    #
-######################
-CMD_ZFS_LIST_SCRIPT: Final[str] = "zfs list -H"
-# Display the names of the snapshots on the specified pool.
-CMD_ZFS_LIST_SNAPSHOT: Final[str] = CMD_ZFS_LIST_SCRIPT + " -o name -t snapshot {pool}"
+from zxybackupcloser.zfsfilesystem import ZfsFilesystem
 
 ######################
 #    Script Code     #
@@ -62,38 +55,49 @@ class Snapshot:
         Args:
             pool: The name of a ZFS pool.
         """
-        LOGGER.debug(f"STR: {pool}")
+        LOGGER.debug("STR: %s", pool)
 
         self.__pool = pool
         self.__latest_raw = ""
-        self.__snapshots = self.__get_list(self.__pool)
+        self.__refresh()
+
+        LOGGER.debug("END")
 
-        LOGGER.debug(f"END")
+    def __refresh(self):
+        """Load the snapshots on the pool and the lists derived from them.
+        """
+        self.__snapshots = self.__get_list(self.__pool)
+        self.__snapshot_set = set(self.__snapshots)
+        # split each name once; the comparison paths reuse the labels.
+        self.__labels = [name.rpartition("@")[2] for name in self.__snapshots]
+        # the list is newest first and fixed until the next refresh.
+        self.__latest = self.__snapshots[0] if self.__snapshots else None
+        self.__earliest = self.__snapshots[-1] if self.__snapshots else None
 
     def take(self):
         """Take a snapshot now.
         """
-        LOGGER.debug(f"STR")
-
-        dry_option = "-n" if self.__dryrun else ""
-
-        # self.__snapshoter commandline as:
-        # ZFS_AUTO_SNAPSHOT_SHORTEST: Final[str] = "zfs-auto-snapshot {dryrun} -qr --label=hourly {pool}"
-
-        snapshot_commandline = self.__snapshoter.format(dryrun=dry_option, pool=self.__pool)
-        snapshot_command = Command(snapshot_commandline)
-        output = snapshot_command.execute(always=True)
+        LOGGER.debug("STR")
 
         if self.__dryrun:
-            # get the output if dryrun auto-snapshot
-            # the output: zfs snapshot -o com.sun:auto-snapshot-desc='-'  'pool1@zfs-auto-snap_hourly-2021-12-11-0557'
-            snapshot_name = output.split("'")[-2]
-            self.__latest_raw = snapshot_name
+            # synthesize the name which zfs-auto-snapshot would take,
+            # e.g., pool1@zfs-auto-snap_hourly-2021-12-11-0557, with no subprocess.
+            now = datetime.datetime.utcnow()
+            self.__latest_raw = f"{self.__pool}@zfs-auto-snap_hourly-{now:%Y-%m-%d-%H%M}"
+        else:
+            # self.__snapshoter commandline as:
+            # ZFS_AUTO_SNAPSHOT_SHORTEST: Final[str] = "zfs-auto-snapshot {dryrun} -qr --label=hourly {pool}"
+            snapshot_commandline = self.__snapshoter.format(dryrun="", pool=self.__pool)
+            snapshot_command = Command(snapshot_commandline)
+            snapshot_command.execute(always=True)
+
+            # dispose the cached snapshots of the pool which miss the new one.
+            ZfsFilesystem.get_instance().refresh_snapshots(self.__pool)
 
         # dispose the old snapshots
-        self.__snapshots = self.__get_list(self.__pool)
+        self.__refresh()
 
-        LOGGER.debug(f"END")
+        LOGGER.debug("END")
 
     def __get_list(self, pool) -> list[str]:
         """Get all of the snapshots on the pool sorted by time in reverse order.
@@ -103,17 +107,14 @@ class Snapshot:
             list[str]: The list of the snapshot names on the pool sorted by time in reverse order.
         """
 
-        # get the list of snapshots on the pool if the pool exists, otherwise the empty list
-        list_snap_cmd = Command(CMD_ZFS_LIST_SNAPSHOT.format(pool=pool))
-        output = list_snap_cmd.execute(always=True)
-
-        snapshots = output.strip().splitlines()
-        snapshots.sort(key=lambda s: re.search(r"\d{4}-\d{2}-\d{2}-\d{4}", s).group(), reverse=True)
+        # get the list of snapshots on the pool if the pool exists, otherwise the empty list.
+        # ZFS already sorts the snapshots by creation time in reverse order.
+        snapshots = ZfsFilesystem.get_instance().get_snapshots(pool)
 
         # add the latest snapshot into the list on memory if under dry-run
         if self.__dryrun and len(self.__latest_raw) > 0:
             snapshots.insert(0, self.__latest_raw)
-            LOGGER.info(f"Add the {self.__latest_raw} snapshot into the list on memory.")
+            LOGGER.info("Add the %s snapshot into the list on memory.", self.__latest_raw)
 
         return snapshots
 
@@ -124,25 +125,29 @@ class Snapshot:
         Returns:
             str: The earliest snapshot
         """
-        LOGGER.debug(f"STR: {snapshot}")
-
-        # Find the start snapshot.
-        earliest = None
-
-        for bsnap in snapshot.get_list():
-            for osnap in self.get_list():
-                blabel = bsnap.split("@")[1]
-                olabel = osnap.split("@")[1]
-                if (blabel == olabel):
-                    earliest = osnap
-                    break
-            else:
-                continue
-            break
-
-        LOGGER.debug(f"END: {earliest}")
+        LOGGER.debug("STR: %s", snapshot)
+
+        earliest = self.__find_latest_common(snapshot)
+
+        LOGGER.debug("END: %s", earliest)
         return earliest
 
+    def __find_latest_common(self, snapshot):
+        """Find the latest snapshot which both this and the specified instance contain.
+        Args:
+            snapshot: A snapshot instance.
+        Returns:
+            str: The latest common snapshot, or None if no common snapshot exists.
+        """
+        # Both lists are sorted by time in reverse order, so the first own
+        # snapshot whose label the other side contains is the latest common one.
+        labels = set(snapshot.get_labels())
+
+        for osnap, label in zip(self.__snapshots, self.__labels):
+            if label in labels:
+                return osnap
+        return None
+
     def contain_snapshot(self, name):
         """Confirm this instance contains a name of the snapshot.
         Args:
@@ -150,7 +155,7 @@ class Snapshot:
         Returns:
             bool: True if this instance contains the snapshot.
         """
-        result = name in self.__snapshots
+        result = name in self.__snapshot_set
         return result
 
     def get_list(self) -> list[str]:
@@ -160,10 +165,15 @@ class Snapshot:
         """
         return self.__snapshots
 
+    def get_labels(self) -> list[str]:
+        """Get the labels, the part after the @, of the snapshots in the same order as get_list().
+        Returns:
+            list[str]: The list of the snapshot labels on the pool sorted by time in reverse order.
+        """
+        return self.__labels
+
     def get_earliest(self):
-        earliest = self.__snapshots[len(self.__snapshots) - 1]
-        return earliest
+        return self.__earliest
 
     def get_latest(self):
-        latest = self.__snapshots[0]
-        return latest
+        return self.__latest
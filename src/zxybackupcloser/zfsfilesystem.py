@@ -4,9 +4,11 @@
 # ZxyBackupCloser is licensed under BSD 2-Clause License.
 
 from typing import ClassVar, Final
+from collections import namedtuple
 import io
 import sys
 import getpass
+import subprocess
 
 from zxybackupcloser.command import Command
 
@@ -15,21 +17,30 @@ from zxybackupcloser.command import Command
 #    ZFS Commands    #
 ######################
 CMD_ZFS_LIST_SCRIPT: Final[str] = "zfs list -H"
-# Display the names of the ZFS pool and dataset on the system.
-CMD_ZFS_LIST_FILESYSTEM: Final[str] = CMD_ZFS_LIST_SCRIPT + " -o name -t filesystem"
+# Display the names of the ZFS pools on the system, without walking the datasets.
+CMD_ZPOOL_LIST: Final[str] = "zpool list -H -o name"
+# Display the name of the specified dataset only.
+CMD_ZFS_LIST_DATASET: Final[str] = CMD_ZFS_LIST_SCRIPT + " -o name {dataset}"
+# Display the names of the snapshots on the specified pool or dataset, the newest first.
+# createtxg is monotonic, matches creation order, and lives in the snapshot header.
+CMD_ZFS_LIST_SNAPSHOT: Final[str] = CMD_ZFS_LIST_SCRIPT + " -d 1 -o name -S createtxg -t snapshot {pool}"
 # Display the names of the ZFS pool and dataset on the system.
 CMD_ZFS_LIST_MOUNTED: Final[str] = CMD_ZFS_LIST_SCRIPT + " -r -o name,encryptionroot,mounted -t filesystem {pool}"
 
 # Mount the specified dataset on the ZFS filesystem.
-CMD_ZFS_MOUNT: Final[str] = "zfs mount -l {dataset}"
+# keep the arguments pre-split; the mount loops append the dataset only.
+CMD_ZFS_MOUNT: Final[tuple] = ("zfs", "mount", "-l")
 # Unmount the specified datasets on the ZFS filesystem.
-CMD_ZFS_UNMOUNT: Final[str] = "zfs unmount -u {dataset}"
+CMD_ZFS_UNMOUNT: Final[tuple] = ("zfs", "unmount", "-u")
 
 # Set disable auto-snapshot which you take with zfs-auto-snapshot.
 CMD_DISABLE_AUTO_SNAPSHOT: Final[str] = "zfs set com.sun:auto-snapshot=false {pool}"
 
 LOGGER = None
 
+# One row of the mounted-status listing.
+MountStatus = namedtuple("MountStatus", ["name", "encryptionroot", "mounted"])
+
 PASSPHRASE_PROMPT: Final[str] = """
 Get the difference of the backups from previous to present.
 Mount the encryption dataset[s] with your passphrase for the diff.
@@ -52,27 +63,79 @@ class ZfsFilesystem:
         Return:
             ZfsFilesystem: The singleton instance.
         """
-        LOGGER.debug(f"STR")
+        LOGGER.debug("STR")
 
         if not cls.__instance:
             instance = ZfsFilesystem()
             cls.__instance = instance
 
-        LOGGER.debug(f"END")
+        LOGGER.debug("END")
         return cls.__instance
 
     def __init__(self):
         """Construct a ZfsList instance.
         """
-        LOGGER.debug(f"STR")
+        LOGGER.debug("STR")
 
         self.__passphrase = ""
 
-        list_command = Command(CMD_ZFS_LIST_FILESYSTEM)
-        output = list_command.execute(always=True)
-        self.__pools = output.strip().splitlines()
+        # load the pool names on the first exist() call, not here.
+        self.__pools = None
+        self.__snapshots = {}
+
+        LOGGER.debug("END")
+
+    def get_snapshots(self, pool):
+        """Get the names of the snapshots on the pool or dataset.
+        List the snapshots of the pool itself only, so the in-kernel
+        traversal is bounded, and cache the result per pool.
+        Args:
+            pool: The name of a ZFS pool or dataset.
+        Returns:
+            list[str]: The list of the snapshot names on the pool.
+        """
+        LOGGER.debug("STR: %s", pool)
+
+        if pool not in self.__snapshots:
+            # collect the names line by line from the stream, never holding
+            # the whole listing as one string beside the list.
+            snapshots = []
+
+            def collect(line):
+                name = line.rstrip("\n")
+                if name:
+                    snapshots.append(name)
 
-        LOGGER.debug(f"END")
+            try:
+                list_command = Command(CMD_ZFS_LIST_SNAPSHOT.format(pool=pool))
+                list_command.execute(stdout_callback=collect, always=True)
+            except subprocess.CalledProcessError:
+                # the dataset may not exist yet, e.g., the first backup under dry-run.
+                snapshots = []
+            self.__snapshots[pool] = snapshots
+
+        snapshots = list(self.__snapshots[pool])
+
+        LOGGER.debug("END")
+        return snapshots
+
+    def refresh_snapshots(self, pool=None):
+        """Dispose the cached snapshot lists, reloaded on the next query.
+        Args:
+            pool: The name of a ZFS pool to dispose it and its datasets only.
+                  Dispose all of the cached lists if None.
+        """
+        LOGGER.debug("STR: %s", pool)
+
+        if pool is None:
+            self.__snapshots = {}
+        else:
+            prefix = pool + "/"
+            stale = [name for name in self.__snapshots if name == pool or name.startswith(prefix)]
+            for name in stale:
+                del self.__snapshots[name]
+
+        LOGGER.debug("END")
 
     def exist(self, pool):
         """Confirm a pool exists.
@@ -81,38 +144,73 @@ class ZfsFilesystem:
         Return:
             bool: True if a pool exists.
         """
-        LOGGER.debug(f"STR: {pool}")
+        LOGGER.debug("STR: %s", pool)
+
+        if "/" in pool:
+            # a backup destination may be a dataset. ask ZFS for the single
+            # name so the listing cost is bounded to the dataset itself.
+            try:
+                list_command = Command(CMD_ZFS_LIST_DATASET.format(dataset=pool))
+                list_command.execute(always=True)
+                result = True
+            except subprocess.CalledProcessError:
+                result = False
+
+            LOGGER.debug("END: %s", result)
+            return result
+
+        if self.__pools is None:
+            list_command = Command(CMD_ZPOOL_LIST)
+            output = list_command.execute(always=True)
+            self.__pools = frozenset(line for line in output.splitlines() if line)
 
         result = pool in self.__pools
 
-        LOGGER.debug(f"END: {result}")
+        LOGGER.debug("END: %s", result)
         return result
 
     def disable_auto_snapshot(self, pool):
-        """Disable auto-snapshot.
+        """Start disabling auto-snapshot without waiting.
+        The "zfs set" is idempotent setup, so overlap it with other work and
+        finish it with Command.wait_async before the backup starts.
         Args:
             pool: The name of a ZFS pool.
+        Return:
+            The running process to pass to Command.wait_async.
         """
-        LOGGER.debug(f"STR: {pool}")
+        LOGGER.debug("STR: %s", pool)
 
         # Disable auto-snapshot which the "zfs set com.sun:auto-snapshot=false" command
         disable_snapshot_commandline = CMD_DISABLE_AUTO_SNAPSHOT.format(pool=pool)
         disable_snapshot_command = Command(disable_snapshot_commandline)
-        disable_snapshot_command.execute()
+        process = disable_snapshot_command.execute_async()
 
-        LOGGER.debug(f"END")
+        LOGGER.debug("END")
+        return process
 
     def prompt_passphrase(self):
         """Ask for your passphrase.
         """
-        LOGGER.debug(f"STR")
+        LOGGER.debug("STR")
 
         if sys.stdin.isatty():
             self.__passphrase = getpass.getpass(prompt=PASSPHRASE_PROMPT)
         else:
             self.__passphrase = sys.stdin.readline().rstrip()
 
-        LOGGER.debug(f"END")
+        LOGGER.debug("END")
+
+    def __list_mounted(self, pool):
+        """List the datasets, encryption roots and mount statuses on the pool.
+        Args:
+            pool: The name of a ZFS pool, or the names joined with spaces.
+        Return:
+            The list of pools or datasets, encryption roots, mount statuses.
+        """
+        command = Command(CMD_ZFS_LIST_MOUNTED.format(pool=pool))
+        output = command.execute(always=True)
+
+        return [MountStatus(*line.split("\t", 2)) for line in output.splitlines() if line]
 
     def mount_pool(self, pool):
         """Mount a pool and its datasets recursively.
@@ -122,27 +220,24 @@ class ZfsFilesystem:
             The previous mount statuses: The list of pools or datasets, encryption roots, mount statuses at the calling this function.
             The result of `zfs list -r -o name,encryptionroot,mounted -t filesystem`.
         """
-        LOGGER.debug(f"STR: {pool}")
+        LOGGER.debug("STR: %s", pool)
 
-        command = Command(CMD_ZFS_LIST_MOUNTED.format(pool=pool))
-        output = command.execute(always=True)
-        mount_statuses = [line.split("\t") for line in output.strip().splitlines()]
+        mount_statuses = self.__list_mounted(pool)
 
         for mount_status in mount_statuses:
-            if mount_status[2] == "yes":
+            if mount_status.mounted == "yes":
                 continue
 
             ppstream = None
             # send the passphrase to the standard input of the mount command if encryptionroot is enabled.
-            if mount_status[1] != "-":
+            if mount_status.encryptionroot != "-":
                 keybin = self.__passphrase.encode()
                 ppstream = io.BytesIO(keybin)
 
-            dataset = mount_status[0]
-            command = Command(CMD_ZFS_MOUNT.format(dataset=dataset))
+            command = Command([*CMD_ZFS_MOUNT, mount_status.name])
             command.execute(stdin_input=ppstream)
 
-        LOGGER.debug(f"END: {mount_statuses}")
+        LOGGER.debug("END: %s", mount_statuses)
         return mount_statuses
 
     def unmount_pool(self, pool):
@@ -153,19 +248,17 @@ class ZfsFilesystem:
             The previous mount statuses: The list of pools or datasets, encryption roots, mount statuses at the calling this function.
             The result of `zfs list -r -o name,encryptionroot,mounted -t filesystem`.
         """
-        LOGGER.debug(f"STR: {pool}")
+        LOGGER.debug("STR: %s", pool)
 
-        command = Command(CMD_ZFS_LIST_MOUNTED.format(pool=pool))
-        output = command.execute(always=True)
-        mount_statues = [line.split("\t") for line in output.strip().splitlines()]
+        mount_statues = self.__list_mounted(pool)
         mount_statues.reverse()
 
         for mount_status in mount_statues:
-            if mount_status[2] == "yes":
-                command = Command(CMD_ZFS_UNMOUNT.format(dataset=mount_status[0]))
+            if mount_status.mounted == "yes":
+                command = Command([*CMD_ZFS_UNMOUNT, mount_status.name])
                 command.execute()
 
-        LOGGER.debug(f"END: {mount_statues}")
+        LOGGER.debug("END: %s", mount_statues)
         return mount_statues
 
     def unmount_dataset(self, mount_statuses):
@@ -173,14 +266,14 @@ class ZfsFilesystem:
         Args:
             mount_statuses: The next mount statuses.
         """
-        LOGGER.debug(f"STR: {mount_statuses}")
+        LOGGER.debug("STR: %s", mount_statuses)
 
         for mount_status in mount_statuses:
-            if mount_status[2] == "no":
-                command = Command(CMD_ZFS_UNMOUNT.format(dataset=mount_status[0]))
+            if mount_status.mounted == "no":
+                command = Command([*CMD_ZFS_UNMOUNT, mount_status.name])
                 command.execute()
 
-        LOGGER.debug(f"END")
+        LOGGER.debug("END")
 
     def has_encryptionroot(self, pools):
         """Confirm a pool in pools has a dataset with the encryptionroot property enabled.
@@ -189,14 +282,12 @@ class ZfsFilesystem:
         Return:
             bool: True if a pool has a dataset with the encryptionroot property enabled.
         """
-        LOGGER.debug(f"STR: {pools}")
+        LOGGER.debug("STR: %s", pools)
 
-        command = Command(CMD_ZFS_LIST_MOUNTED.format(pool=" ".join(pools)))
-        output = command.execute(always=True)
-        mount_statuses = [line.split("\t") for line in output.strip().splitlines()]
+        mount_statuses = self.__list_mounted(" ".join(pools))
 
-        encryptionroots = [mount_status[1] for mount_status in mount_statuses if mount_status[1] != "-"]
-        result = len(encryptionroots) > 0
+        # stop at the first encryption root instead of collecting them all.
+        result = any(mount_status.encryptionroot != "-" for mount_status in mount_statuses)
 
-        LOGGER.debug(f"END: {result}")
+        LOGGER.debug("END: %s", result)
         return result